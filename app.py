@@ -1,10 +1,16 @@
 from fastapi import FastAPI, Request, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, PlainTextResponse, JSONResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+import jinja2
 from typing import List
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import asyncio
+import bisect
 import csv
+import io
+import re
 
 app = FastAPI(title="Maintenance Email Generator")
 
@@ -13,116 +19,184 @@ templates = Jinja2Templates(directory="templates")
 
 # ---------------- TSV parsing ----------------
 
-def parse_uploaded_tsv(file: UploadFile) -> list[tuple[str,str]]:
-    if file is None:
-        return []
-    content = file.file.read()
-    if not content:
-        return []
+# One compiled, case-insensitive match replaces the upper() call and the
+# four-way test ladder per CID. Alternative order mirrors the old checks:
+# skip OC-900001 rows first, then WL-/WLP- anywhere, then the 3POC and OC
+# prefixes; m.lastindex tells us which branch fired.
+# re.S lets the WL scan cross newlines inside multi-line quoted cells.
+_CLASSIFY_RE = re.compile(r"(OC-900001)|(.*?(?:WLP-|WL-))|(3POC)|(OC)", re.I | re.S)
+_CLASSIFY_MATCH = _CLASSIFY_RE.match
+
+# Status/header tokens that sometimes leak into the CID column.
+_SKIP_CIDS = frozenset({"ENABLED","DISABLED","CID","LABEL"})
+
+def _insort_unique(seen: set, out: list, value: str) -> None:
+    # Dedup through the set, keep the output list sorted as it grows; this
+    # skips the final sorted(set) pass and degenerates to O(n) appends when
+    # the TSV is already sorted.
+    if value not in seen:
+        seen.add(value)
+        bisect.insort(out, value)
+
+def _flatten_cell(s: str) -> str:
+    # The old line-based parser collapsed multi-line quoted cells into one
+    # line; keep each impacted-customer entry single-line in the email body.
+    if "\n" in s or "\r" in s:
+        s = s.replace("\r", "").replace("\n", "")
+    return s.strip()
+
+def _classify_row(r: list, cid_idx: int, label_idx: int, wl, oc, poc3) -> None:
+    cid = _flatten_cell(r[cid_idx]) if cid_idx < len(r) else ""
+    if not cid:
+        return
+    if cid.upper() in _SKIP_CIDS:
+        return
+    m = _CLASSIFY_MATCH(cid)
+    if m is None:
+        return
+    gi = m.lastindex
+    if gi == 1:
+        return
+    if gi == 2:
+        _insort_unique(*wl, cid)
+        return
+    label = _flatten_cell(r[label_idx]) if label_idx < len(r) else ""
+    _insort_unique(*(poc3 if gi == 3 else oc), f"{cid} ({label})" if label else cid)
+
+def _classify_bytes(content: bytes, wl, oc, poc3) -> None:
+    # Single streaming pass over the upload: sniff the CID/Label header among
+    # the first rows while classifying everything after it, instead of
+    # materializing all rows and re-walking the head to locate the columns.
+    # Universal newlines replace the old \r\n/\r normalization.
+    # Strict UTF-8 first (one exception-free pass for the common case), then
+    # the legacy cp1251 fallback so Cyrillic labels survive intact.
     try:
-        text = content.decode("utf-8")
+        decoded = content.decode("utf-8")
     except UnicodeDecodeError:
         try:
-            text = content.decode("cp1251", errors="strict")
+            decoded = content.decode("cp1251")
         except UnicodeDecodeError:
-            text = content.decode("latin-1", errors="ignore")
-    text = text.replace("\r\n", "\n").replace("\r", "\n")
-
-    lines = []
-    for ln in text.split("\n"):
-        s = ln.strip()
-        if not s:
-            continue
-        if s.startswith("#"):
-            if "CID" in s and "Label" in s:
-                s = s.lstrip("#").strip()
-                lines.append(s)
-            continue
-        lines.append(s)
-
-    rows = list(csv.reader(lines, delimiter="\t"))
-    cid_idx = None; label_idx = None; header_row = None
-    for i in range(min(5, len(rows))):
-        low = [c.strip().lower() for c in rows[i]]
-        if "cid" in low and "label" in low:
-            cid_idx = low.index("cid"); label_idx = low.index("label"); header_row = i; break
-    data_rows = rows[header_row+1:] if header_row is not None else rows
-    if cid_idx is None: cid_idx = 0
-    if label_idx is None: label_idx = 1
-
-    pairs = []
-    for r in data_rows:
-        if not r: 
+            decoded = content.decode("latin-1", errors="ignore")
+    text = io.StringIO(decoded, newline="")
+    cid_idx = 0; label_idx = 1
+    pending = []  # rows held back while still sniffing for a header
+    classify_row = _classify_row  # local binding for the per-row loop
+    for row in csv.reader(text, delimiter="\t"):
+        # The old parser stripped each raw line before splitting; mirror that
+        # by discarding leading empty cells so a whitespace-indented row does
+        # not shift the CID/Label columns.
+        while row and not row[0].strip():
+            row = row[1:]
+        if not row:
             continue
-        cid = r[cid_idx].strip() if cid_idx < len(r) else ""
-        label = r[label_idx].strip() if label_idx < len(r) else ""
-        if not cid:
-            continue
-        up = cid.upper()
-        if up in {"ENABLED","DISABLED","CID","LABEL"}:
+        first = row[0].lstrip()
+        if first.startswith("#"):
+            joined = "\t".join(row)
+            if "CID" in joined and "Label" in joined:
+                # Reconstitute and re-strip the whole line as the old parser
+                # did, so "#\tCID\tLabel" loses the empty leading cell instead
+                # of shifting the header columns right.
+                row = "\t".join([first.lstrip("#")] + row[1:]).strip().split("\t")
+            else:
+                continue
+        if pending is not None:
+            low = [c.strip().lower() for c in row]
+            if "cid" in low and "label" in low:
+                cid_idx = low.index("cid"); label_idx = low.index("label")
+                pending = None  # rows before the header are junk
+                continue
+            pending.append(row)
+            if len(pending) >= 5:
+                # No header in the leading rows; everything is data.
+                for r in pending:
+                    classify_row(r, cid_idx, label_idx, wl, oc, poc3)
+                pending = None
             continue
-        pairs.append((cid, label))
-    return pairs
+        classify_row(row, cid_idx, label_idx, wl, oc, poc3)
+    if pending:
+        for r in pending:
+            classify_row(r, cid_idx, label_idx, wl, oc, poc3)
 
-def collect_pairs(files: List[UploadFile]) -> list[tuple[str,str]]:
-    all_pairs = []
+async def collect_and_classify(files: List[UploadFile]):
+    wl = (set(), []); oc = (set(), []); poc3 = (set(), [])
     for f in files or []:
-        all_pairs.extend(parse_uploaded_tsv(f))
-    return all_pairs
-
-def classify_wl_oc_3poc(pairs: list[tuple[str,str]]):
-    wl_wlp, oc_list, poc3_list = set(), set(), set()
-    for cid, label in pairs:
-        up = cid.upper()
-        if up.startswith("OC-900001"):
-            continue
-        if ("WLP-" in up) or ("WL-" in up):
-            wl_wlp.add(cid)
+        if f is None:
             continue
-        if up.startswith("3POC"):
-            poc3_list.add(f"{cid} ({label})" if label else cid)
-            continue
-        if up.startswith("OC"):
-            oc_list.add(f"{cid} ({label})" if label else cid)
-            continue
-    return sorted(wl_wlp), sorted(oc_list), sorted(poc3_list)
+        # Read through the async interface so concurrent previews don't
+        # block the event loop, then push the CPU-bound parse to a thread.
+        await f.seek(0)
+        content = await f.read()
+        if content:
+            await asyncio.to_thread(_classify_bytes, content, wl, oc, poc3)
+    return wl[1], oc[1], poc3[1]
 
 # ---------------- Time helpers (UTC+0 display) ----------------
 
-def parse_to_utc(date_str: str, time_str: str, utc_offset_str: str):
+# Fixed-offset tzinfo objects keyed by offset minutes; only a handful of
+# offsets ever occur per deployment, so cache them instead of allocating
+# a timedelta+timezone pair on every parse.
+_TZ_CACHE: dict[int, timezone] = {}
+
+# Strips the sign characters in one translate pass instead of two
+# chained replace() scans.
+_SIGN_TABLE = str.maketrans("", "", "+-")
+
+@lru_cache(maxsize=256)
+def _parse_offset_minutes(offs: str) -> int:
+    try:
+        if ":" in offs:
+            sign = -1 if offs.startswith("-") else 1
+            hh, mm = offs.translate(_SIGN_TABLE).split(":")
+            return sign * (int(hh)*60 + int(mm))
+        if "." in offs:
+            sign = -1 if offs.startswith("-") else 1
+            val = float(offs.translate(_SIGN_TABLE))
+            hh = int(val); mm = int(round((val-hh)*60))
+            return sign * (hh*60 + mm)
+        return int(float(offs))*60 if offs else 0
+    except Exception:
+        return 0
+
+@lru_cache(maxsize=1024)
+def _parse_to_utc_cached(date_str: str, time_str: str, utc_offset_str: str):
     try:
-        date_str = (date_str or "").strip()
-        time_str = (time_str or "").strip()
+        date_str = date_str.strip()
+        time_str = time_str.strip()
         if not date_str or not time_str:
             return None
-        offs = (utc_offset_str or "").strip().replace("UTC","").strip()
+        offs = utc_offset_str.strip().replace("UTC","").strip()
         d, m, y = date_str.split("/")
         if len(y) == 2: y = "20" + y
-        naive = datetime.strptime(f"{d}/{m}/{y} {time_str}", "%d/%m/%Y %H:%M")
-        try:
-            if ":" in offs:
-                sign = -1 if offs.startswith("-") else 1
-                hh, mm = offs.replace("+","").replace("-","").split(":")
-                minutes = sign * (int(hh)*60 + int(mm))
-            elif "." in offs:
-                sign = -1 if offs.startswith("-") else 1
-                val = float(offs.replace("+","").replace("-",""))
-                hh = int(val); mm = int(round((val-hh)*60))
-                minutes = sign * (hh*60 + mm)
-            else:
-                minutes = int(float(offs))*60 if offs else 0
-        except Exception:
-            minutes = 0
-        tz_local = timezone(timedelta(minutes=minutes))
+        if len(y) != 4:
+            # strptime's %Y only took 4-digit years; keep rejecting partial
+            # input like "01/02/202" typed mid-edit.
+            return None
+        hh, mm = time_str.split(":")
+        # The format is fixed, so build the datetime directly instead of
+        # round-tripping through an f-string and strptime's format interpreter.
+        naive = datetime(int(y), int(m), int(d), int(hh), int(mm))
+        minutes = _parse_offset_minutes(offs)
+        tz_local = _TZ_CACHE.get(minutes) or _TZ_CACHE.setdefault(minutes, timezone(timedelta(minutes=minutes)))
         return naive.replace(tzinfo=tz_local).astimezone(timezone.utc)
     except Exception:
         return None
 
+def parse_to_utc(date_str: str, time_str: str, utc_offset_str: str):
+    # datetime is immutable, so memoizing on the raw form strings is safe;
+    # preview requests resubmit the same triple constantly. Empty fields
+    # (the interactive default) never reach the cache.
+    if not date_str or not time_str:
+        return None
+    return _parse_to_utc_cached(date_str, time_str, utc_offset_str or "")
+
+_DATE_FMT = "%d/%m/%Y"
+_TIME_FMT = "%H:%M"
+
 def fmt_date_utc(dt) -> str:
-    return dt.strftime("%d/%m/%Y") if dt else ""
+    return dt.strftime(_DATE_FMT) if dt else ""
 
 def fmt_time_utc(dt) -> str:
-    return dt.strftime("%H:%M") if dt else ""
+    return dt.strftime(_TIME_FMT) if dt else ""
 
 def humanize_minutes(mins: int) -> str:
     h, m = divmod(max(mins or 0,0), 60)
@@ -132,14 +206,61 @@ def humanize_minutes(mins: int) -> str:
 
 # ---------------- Email builder ----------------
 
-def build_email(jira_ref: str, pop: str, equipment: str, line: str,
+# Spellings of "no downtime" accepted in the override field.
+_ZERO_ALIASES = frozenset({"0","0m","0min","0 minutes","0mins","0h","0 hr","0 hrs"})
+
+# Canonical values of the purpose checkboxes in templates/index.html; a dict
+# hit skips the per-request strip() for the values the form actually sends.
+PURPOSE_PRESETS: dict[str, str] = {p: p for p in (
+    "Network upgrade",
+    "Capacity expansion",
+    "Software updates",
+    "Optical spectrum optimization",
+    "Digital capacity optimization",
+    "Equipment migration",
+    "Replace of broken equipment",
+)}
+
+# Compiled once at import; Jinja2 generates bytecode for the substitutions
+# instead of re-interpreting a multi-line f-string on every preview.
+_BODY_TMPL = jinja2.Template("""Dear Team,
+
+As part of our ongoing efforts to improve the reliability and performance of our network, we will be carrying out planned maintenance as outlined below:
+
+PoP/Devices/LINE:
+{{ pop_equip_line }}
+
+Maintenance Window (UTC+0):
+Start: {{ start_date_d }} {{ start_time_utc }}
+End:   {{ end_date_d }} {{ end_time_utc }}
+
+Purpose of Maintenance:
+{{ purpose_block }}
+
+Affected Customers/Services:
+{{ impacted_text }}
+
+Expected Impact:
+{{ impact_block }}
+""", keep_trailing_newline=True)
+
+def _fmt_block(title: str, items) -> str:
+    # Pre-indented separator: one join per category instead of a generator
+    # plus an f-string per CID.
+    return title + "\n  " + "\n  ".join(items) if items else ""
+
+async def build_email(jira_ref: str, pop: str, equipment: str, line: str,
                 start_date: str, start_time: str,
                 end_date: str, end_time: str,
                 utc_single: str, override_downtime: str,
                 purpose_presets: List[str], purpose_free: str,
                 files: List[UploadFile]):
-    pairs = collect_pairs(files)
-    wl_wlp, oc_list, poc3_list = classify_wl_oc_3poc(pairs)
+    if files:
+        wl_wlp, oc_list, poc3_list = await collect_and_classify(files)
+    else:
+        # Preview-as-you-type mostly arrives with no uploads; skip the whole
+        # TSV/classification pipeline in that case.
+        wl_wlp = oc_list = poc3_list = ()
 
     start_utc = parse_to_utc(start_date, start_time, utc_single)
     end_utc = parse_to_utc(end_date, end_time, utc_single)
@@ -149,74 +270,57 @@ def build_email(jira_ref: str, pop: str, equipment: str, line: str,
             end_utc += timedelta(days=1)
         calc_downtime_mins = int((end_utc - start_utc).total_seconds() // 60)
 
-    override = (override_downtime or "").strip().lower()
-    zero_aliases = {"0","0m","0min","0 minutes","0mins","0h","0 hr","0 hrs"}
-    if override in zero_aliases:
-        downtime_final = "0"
+    override = override_downtime.strip().lower() if override_downtime else ""
+    if override in _ZERO_ALIASES:
+        downtime_final = "0"; is_zero = True
     elif override:
-        downtime_final = override_downtime.strip()
+        downtime_final = override_downtime.strip(); is_zero = False
     elif calc_downtime_mins is not None:
         downtime_final = humanize_minutes(calc_downtime_mins)
+        is_zero = downtime_final in _ZERO_ALIASES
     else:
-        downtime_final = "[specify]"
+        downtime_final = "[specify]"; is_zero = False
 
     start_date_d = fmt_date_utc(start_utc)
     end_date_d = fmt_date_utc(end_utc)
     start_time_utc = fmt_time_utc(start_utc)
     end_time_utc = fmt_time_utc(end_utc)
-    subject_dt = ", ".join(x for x in [
-        " - ".join(x for x in [start_date_d, end_date_d] if x),
-        " - ".join(x for x in [start_time_utc, end_time_utc] if x),
-        "UTC+0"
-    ] if x).strip(", ")
+    date_part = start_date_d + " - " + end_date_d if start_date_d and end_date_d else (start_date_d or end_date_d)
+    time_part = start_time_utc + " - " + end_time_utc if start_time_utc and end_time_utc else (start_time_utc or end_time_utc)
+    subject_dt = ", ".join(p for p in (date_part, time_part, "UTC+0") if p)
     # Bracketed subject variables
     subject = f"Planned Network Maintenance – [{(jira_ref or '').strip()}] [{(pop or '').strip()} / {(equipment or '').strip()}] – [{subject_dt}]".strip()
 
     purposes = []
     for p in purpose_presets or []:
-        p = p.strip()
+        p = PURPOSE_PRESETS.get(p) or p.strip()
         if p: purposes.append(p)
     if purpose_free and purpose_free.strip():
         purposes.append(purpose_free.strip())
     purpose_block = "; ".join(purposes) if purposes else "[Enter purpose here]"
 
-    blocks = []
-    if wl_wlp:
-        blocks.append("WL / WLP:\n" + "\n".join(f"  {x}" for x in wl_wlp))
-    if oc_list:
-        blocks.append("OC:\n" + "\n".join(f"  {x}" for x in oc_list))
-    if poc3_list:
-        blocks.append("3POC:\n" + "\n".join(f"  {x}" for x in poc3_list))
-    impacted_text = "\n\n".join(blocks) if blocks else "(none detected)"
+    impacted_text = "\n\n".join(filter(None, (
+        _fmt_block("WL / WLP:", wl_wlp),
+        _fmt_block("OC:", oc_list),
+        _fmt_block("3POC:", poc3_list),
+    ))) or "(none detected)"
 
     line_str = (line or "").strip()
     pop_equip_line = f"{(pop or '').strip()} / {(equipment or '').strip()}" + (f" / {line_str}" if line_str else "")
 
-    if downtime_final.lower() in zero_aliases or downtime_final == "0":
+    if is_zero:
         impact_block = "No service interruption is anticipated."
     else:
         impact_block = f"Downtime: {downtime_final}"
 
-    body = f"""Dear Team,
-
-As part of our ongoing efforts to improve the reliability and performance of our network, we will be carrying out planned maintenance as outlined below:
-
-PoP/Devices/LINE:
-{pop_equip_line}
-
-Maintenance Window (UTC+0):
-Start: {start_date_d} {start_time_utc}
-End:   {end_date_d} {end_time_utc}
-
-Purpose of Maintenance:
-{purpose_block}
-
-Affected Customers/Services:
-{impacted_text}
-
-Expected Impact:
-{impact_block}
-"""
+    body = _BODY_TMPL.render(
+        pop_equip_line=pop_equip_line,
+        start_date_d=start_date_d, start_time_utc=start_time_utc,
+        end_date_d=end_date_d, end_time_utc=end_time_utc,
+        purpose_block=purpose_block,
+        impacted_text=impacted_text,
+        impact_block=impact_block,
+    )
     calculated_downtime = humanize_minutes(calc_downtime_mins) if calc_downtime_mins is not None else ""
     return subject, body, calculated_downtime
 
@@ -226,7 +330,7 @@ Expected Impact:
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
-@app.post("/api/preview")
+@app.post("/api/preview", response_class=ORJSONResponse)
 async def api_preview(
     jira_ref: str = Form(""),
     pop: str = Form(""),
@@ -243,16 +347,16 @@ async def api_preview(
     files: List[UploadFile] = File(None),
 ):
     try:
-        subject, body, calc_dt = build_email(
+        subject, body, calc_dt = await build_email(
             jira_ref, pop, equipment, line,
             start_date, start_time, end_date, end_time,
             utc_single, override_downtime,
             purpose_presets or [], purpose_free,
             files
         )
-        return JSONResponse({"ok": True, "subject": subject, "body": body, "calculated_downtime": calc_dt})
+        return ORJSONResponse({"ok": True, "subject": subject, "body": body, "calculated_downtime": calc_dt})
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)})
+        return ORJSONResponse({"ok": False, "error": str(e)})
 
 @app.post("/download.txt")
 async def download_txt(subject: str = Form(...), body: str = Form(...)):